@@ -0,0 +1,198 @@
+import json
+import functools
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+# orjson is optional, it is considerably faster on the larger contracts and
+# API responses
+try:
+    import orjson
+
+    def _dumps(data):
+        return orjson.dumps(
+            data, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE
+        )
+
+    loads = orjson.loads
+except ImportError:
+
+    def _dumps(data):
+        return (json.dumps(data, indent=2) + "\n").encode()
+
+    loads = json.loads
+
+_MISSING = object()
+
+# concurrent API calls, also sizes the HTTP connection pools
+MAX_WORKERS = 8
+
+
+def find_expectations(name):
+    print("Contract is being used in:")
+    result = subprocess.run(
+        ["git", "--no-pager", "grep", "-n", "-F", "--", name],
+        capture_output=True,
+        text=True,
+    )
+    for line in result.stdout.splitlines():
+        # skip matches in the contracts themselves, keep their usages
+        if "contracts" not in line.split(":", 1)[0]:
+            print(line)
+
+
+def persist_contract(name, remote, data):
+    with open("contracts/{}/{}".format(remote, name), "wb") as fh:
+        fh.write(_dumps(data))
+
+
+class ContractDataName:
+    def __init__(self, name, data, is_list=False):
+        self.name = name
+        self.data = data
+        # upstream returns a list, only its first element is verified
+        self.is_list = is_list
+        # validator generated once per contract
+        self.validator = compile_validator(data)
+
+
+def compile_validator(expected):
+    # Generate a straight-line validator for the contract, one key lookup
+    # and one type check per key. It returns None when the upstream JSON
+    # honours the contract and the error message otherwise.
+    namespace = {
+        # bound as globals of the generated code, avoiding builtin lookups
+        "_type": type,
+        "_missing": _MISSING,
+        "_mismatch": _mismatch,
+        "_response_mismatch": _response_mismatch,
+        "t0": dict,
+    }
+    type_names = {dict: "t0"}
+    # the response itself must be an object before any key is looked up
+    lines = [
+        "def validator(v0):",
+        "    if _type(v0) is not t0:",
+        "        return _response_mismatch(t0, v0)",
+    ]
+    count = 0
+    # iterative walk, checks for a node are emitted before its children
+    stack = [("v0", expected)]
+    while stack:
+        parent, node = stack.pop()
+        for key, value in node.items():
+            count += 1
+            var = "v{}".format(count)
+            value_type = type(value)
+            if value_type not in type_names:
+                type_names[value_type] = "t{}".format(len(type_names))
+                namespace[type_names[value_type]] = value_type
+            type_name = type_names[value_type]
+            lines += [
+                "    {} = {}.get({!r}, _missing)".format(var, parent, key),
+                "    if {} is _missing:".format(var),
+                "        return {!r}".format(
+                    "Expected JSON key [{}] not found in upstream".format(key)
+                ),
+                "    if _type({}) is not {}:".format(var, type_name),
+                "        return _mismatch({!r}, {}, {})".format(key, type_name, var),
+            ]
+            if value_type is dict:
+                stack.append((var, value))
+    lines.append("    return None")
+    exec("\n".join(lines), namespace)
+    return namespace["validator"]
+
+
+def _mismatch(key, expected_type, value):
+    return "Type mismatch for key [{}]: expected [{}] but got [{}]".format(
+        key, expected_type, type(value)
+    )
+
+
+def _response_mismatch(expected_type, value):
+    return "Type mismatch for upstream response: expected [{}] but got [{}]".format(
+        expected_type, type(value)
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_contract_json(name, remote):
+    data_json = loads(Path("contracts", remote, name).read_bytes())
+    if isinstance(data_json, list):
+        # gather one element from list. We just need to verify keys and
+        # types of values.
+        return ContractDataName(name, data_json[0], is_list=True)
+    return ContractDataName(name, data_json)
+
+
+@dataclass(frozen=True, slots=True)
+class TestAPI:
+    callback: Callable
+    msg: str
+    # contracts, or callables returning them, one per API response
+    expected: tuple
+
+
+def validate_responses(testcases):
+    # API calls are I/O bound, fetch all of them concurrently and verify
+    # results in submission order to keep the output stable. All testcases
+    # are submitted up front, so a failing contract does not stop calls
+    # already in flight, write requests included. They run to completion
+    # and their errors are reported.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(_fetch, testcase) for testcase in testcases]
+        for testcase, future in zip(testcases, futures):
+            if not _validate_response(testcase, *future.result()):
+                _drain(testcases, futures)
+                return False
+    return True
+
+
+def _drain(testcases, futures):
+    # cancel testcases not started yet, wait for the rest
+    for future in futures:
+        future.cancel()
+    for testcase, future in zip(testcases, futures):
+        if future.cancelled():
+            continue
+        error = future.exception()
+        if error is not None:
+            sys.stdout.write("{}... ERROR\n{!r}\n".format(testcase.msg, error))
+
+
+def _fetch(testcase):
+    actual = testcase.callback()
+    # contracts are loaded lazily, only once the API call has succeeded. This
+    # runs in the worker, so loading overlaps with the other API calls.
+    expected_values = [e() if callable(e) else e for e in testcase.expected]
+    return actual, expected_values
+
+
+def _verify(expected, actual):
+    if expected.is_list:
+        if type(actual) is not list:
+            return _response_mismatch(list, actual)
+        if not actual:
+            return "Expected a non-empty list in upstream"
+        actual = actual[0]
+    return expected.validator(actual)
+
+
+def _validate_response(testcase, actual, expected_values):
+    # one response per expected contract, a tuple when there are several
+    verifications = [(expected_values[0], actual)]
+    if len(expected_values) > 1:
+        verifications = zip(expected_values, actual)
+    for expected, actual in verifications:
+        error = _verify(expected, actual)
+        if error is not None:
+            # one write per testcase, status and error go out together
+            sys.stdout.write("{}... FAIL\n{}\n".format(testcase.msg, error))
+            find_expectations(expected.name)
+            return False
+    sys.stdout.write("{}... OK\n".format(testcase.msg))
+    return True
@@ -1,124 +1,95 @@
-import requests
-import json
-import os
 import argparse
-import sys
-
-API_TOKEN = os.environ["GITHUB_TOKEN"]
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--persist", action="store_true")
-args = parser.parse_args()
-
-
-def find_expectations(name):
-    print("Contract is being used in:")
-    os.system("git --no-pager grep -n " + name + " | grep -v contracts")
+import os
 
+import requests
 
-def persist_contract(name, data):
-    with open("contracts/github/{}".format(name), "w") as fh:
-        json.dump(data, fh, indent=2)
-        fh.write("\n")
+from validation import (
+    TestAPI,
+    get_contract_json,
+    persist_contract,
+    validate_responses,
+)
 
+REMOTE = "github"
+API_TOKEN = os.environ["GITHUB_TOKEN"]
 
-def create_merge_request_api():
+HEADERS = {
+    "Authorization": f"bearer {API_TOKEN}",
+    "Accept": "application/vnd.github.v3+json",
+    "X-GitHub-Api-Version": "2022-11-28",
+}
+
+# shared session, reuses the same pooled connection across API calls
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+
+# fake identifiers so that persisted contracts do not leak real user data
+USER_PATCH = {
+    "id": 123456,
+    "node_id": "abcdefg",
+    "avatar_url": "https://any_url_test.test",
+}
+ID_PATCH = {"id": 123456, "node_id": "abcdefg"}
+USER_PATHS = (
+    ("user",),
+    ("head", "user"),
+    ("head", "repo", "owner"),
+    ("base", "user"),
+    ("base", "repo", "owner"),
+)
+# the pull request itself and its head and base repositories
+ID_PATHS = ((), ("head", "repo"), ("base", "repo"))
+
+
+def _patch_paths(data, paths, patch):
+    for path in paths:
+        node = data
+        for key in path:
+            node = node[key]
+        node.update(patch)
+
+
+def fake_user_data(data):
+    _patch_paths(data, ID_PATHS, ID_PATCH)
+    _patch_paths(data, USER_PATHS, USER_PATCH)
+
+
+def create_merge_request_api(persist):
     url = "https://api.github.com/repos/jordilin/githapi/pulls"
     source_branch = "feature"
     target_branch = "main"
     title = "New Feature"
-    headers = {
-        "Authorization": f"bearer {API_TOKEN}",
-        "Accept": "application/vnd.github.v3+json",
-    }
     body = {
         "title": title,
         "head": source_branch,
         "base": target_branch,
         "body": "This is a new feature",
     }
-    response = requests.post(url, headers=headers, data=json.dumps(body))
+    response = SESSION.post(url, json=body)
     assert response.status_code == 201
     data = response.json()
-    if args.persist:
-        persist_contract("merge_request.json", data)
-        sys.exit(0)
+    fake_user_data(data)
+    if persist:
+        persist_contract("merge_request.json", REMOTE, data)
     return data
 
 
-def get_contract_json(name):
-    with open("contracts/github/{}".format(name)) as fh:
-        return json.load(fh)
-
-
-def _verify_all_keys_exist(expected, actual):
-    for key in expected:
-        if key not in actual:
-            print("Expected JSON key [{}] not found in upstream".format(key))
-            return False
-        if type(expected[key]) == dict:
-            # API responses checked are not more than one level deep
-            if not _verify_all_keys_exist(expected[key], actual[key]):
-                return False
-    return True
-
-
-def _verify_types_of_values(expected, actual):
-    for key in expected:
-        if type(expected[key]) != type(actual[key]):
-            print(
-                "Type mismatch for key [{}]: expected [{}] but got [{}]".format(
-                    key, type(expected[key]), type(actual[key])
-                )
-            )
-            return False
-        if type(expected[key]) == dict:
-            # API responses checked are not more than one level deep
-            if not _verify_types_of_values(expected[key], actual[key]):
-                return False
-    return True
-
-
-def verify_all(expected, actual):
-    if not _verify_all_keys_exist(expected, actual):
-        return False
-    if not _verify_types_of_values(expected, actual):
-        return False
-    return True
-
-
-class TestAPI:
-    def __init__(self, callback, msg, *expected):
-        self.callback = callback
-        self.msg = msg
-        self.expected = expected
-
-
-def validate_responses(testcases):
-    for testcase in testcases:
-        actual = testcase.callback()
-        print("{}... ".format(testcase.msg), end="")
-        verifications = []
-        if type(actual) == tuple:
-            verifications = zip(testcase.expected, actual)
-        else:
-            verifications = zip(testcase.expected, [actual])
-        for expected, actual in verifications:
-            if not verify_all(expected, actual):
-                return False
-        print("OK")
-    return True
-
-
-if __name__ == "__main__":
+def main(persist):
     testcases = [
         TestAPI(
-            create_merge_request_api,
+            lambda: create_merge_request_api(persist),
             "merge request API contract",
-            get_contract_json("merge_request.json"),
+            (lambda: get_contract_json("merge_request.json", REMOTE),),
         ),
     ]
     if not validate_responses(testcases):
         exit(1)
     # TODO
     # # get_project_members_api_json()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--persist", action="store_true")
+    args = parser.parse_args()
+    main(args.persist)
@@ -1,196 +1,206 @@
-import requests
-import json
-import os
 import argparse
+import os
 
-PRIVATE_TOKEN = os.environ["GITLAB_TOKEN"]
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--persist", action="store_true")
-args = parser.parse_args()
-
-
-def find_expectations(name):
-    print("Contract is being used in:")
-    os.system("git --no-pager grep -n " + name + " | grep -v contracts")
-
-
-def persist_contract(name, data):
-    with open("contracts/gitlab/{}".format(name), "w") as fh:
-        json.dump(data, fh, indent=2)
-        fh.write("\n")
-
-
-def get_project_api_json():
-    url = "https://gitlab.com/api/v4/projects/jordilin%2Fgitlapi"
-    headers = {"PRIVATE-TOKEN": PRIVATE_TOKEN}
-    response = requests.get(url, headers=headers)
-    data = response.json()
-
-    data["runners_token"] = "REDACTED"
-    data["namespace"]["avatar_url"] = "https://any_url_test.test"
-    data["owner"]["avatar_url"] = "https://any_url_test.test"
-    data["service_desk_address"] = "https://any_url_test.test"
-    data["owner"]["id"] = 123456
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from validation import (
+    MAX_WORKERS,
+    TestAPI,
+    get_contract_json,
+    loads,
+    persist_contract,
+    validate_responses,
+)
+
+REMOTE = "gitlab"
+
+# fake values replacing sensitive or volatile data in persisted contracts
+FAKE_URL = "https://any_url_test.test"
+FAKE_ID = 123456
+FAR_FUTURE = "2060-03-20T06:26:02.725Z"
+
+# (path to a dict, fields to override in it) applied to the project response
+PROJECT_PATCH = (
+    ((), {"runners_token": "REDACTED", "service_desk_address": FAKE_URL}),
+    (("namespace",), {"avatar_url": FAKE_URL}),
+    (("owner",), {"avatar_url": FAKE_URL, "id": FAKE_ID}),
     # change to a long time ago to avoid flaky tests
-    data["container_expiration_policy"]["next_run_at"] = "2060-03-20T06:26:02.725Z"
-    if args.persist:
-        persist_contract("project.json", data)
+    (("container_expiration_policy",), {"next_run_at": FAR_FUTURE}),
+)
+
+# (connect, read) seconds, a stalled connection must not hang the run
+TIMEOUT = (5, 30)
+# POSTs are not retried, re-creating a merge request is not idempotent
+RETRY = Retry(
+    total=3,
+    backoff_factor=0.3,
+    status_forcelist=(502, 503, 504),
+    allowed_methods=frozenset(["GET"]),
+)
+
+def new_session(private_token):
+    # shared session, reuses the same pooled connection across API calls
+    if os.environ.get("GITLAB_CONTRACTS_CACHE"):
+        # opt-in, serve repeated GET requests from a local sqlite cache for a
+        # day. Only successful GETs are cached, the merge request POSTs always
+        # go out.
+        from requests_cache import CachedSession
+
+        session = CachedSession(
+            "gitlab_contracts",
+            expire_after=86400,
+            allowable_methods=("GET",),
+            allowable_codes=(200,),
+            ignored_parameters=["PRIVATE-TOKEN"],
+        )
+    else:
+        session = requests.Session()
+    session.headers.update({"PRIVATE-TOKEN": private_token})
+    # single host, keep up to one idle connection per concurrent testcase
+    session.mount(
+        "https://",
+        HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS, max_retries=RETRY),
+    )
+    return session
+
+
+def _apply(data, patches):
+    for path, fields in patches:
+        node = data
+        for key in path:
+            node = node[key]
+        node.update(fields)
+
+
+def _redact_user(user, i):
+    fake_url = f"{FAKE_URL}{i}"
+    user.update(
+        {
+            "avatar_url": fake_url,
+            "web_url": fake_url,
+            "id": FAKE_ID + i,
+            "username": f"test_user_{i}",
+            "name": f"Test User {i}",
+        }
+    )
+
+
+def get_project_api_json(session, persist):
+    url = "https://gitlab.com/api/v4/projects/jordilin%2Fgitlapi"
+    response = session.get(url, timeout=TIMEOUT)
+    response.raise_for_status()
+    data = loads(response.content)
+
+    _apply(data, PROJECT_PATCH)
+    if persist:
+        persist_contract("project.json", REMOTE, data)
     return data
 
 
-def get_project_members_api_json():
+def get_project_members_api_json(session, persist):
+    # only needed to refresh the contract, skip the round trip otherwise
+    if not persist:
+        return []
     url = "https://gitlab.com/api/v4/projects/gitlab-org%2Fgitlab/members"
-    headers = {"PRIVATE-TOKEN": PRIVATE_TOKEN}
     # members API is paginated, gather headers to test pagination
-    response = requests.get(url, headers=headers)
+    response = session.get(url, timeout=TIMEOUT)
+    response.raise_for_status()
+    members = loads(response.content)
     # take first two members and fake data
-    data = response.json()[:2]
+    data = members[:2]
     for i, member in enumerate(data):
-        member["avatar_url"] = "https://any_url_test.test" + str(i)
-        member["web_url"] = "https://any_url_test.test" + str(i)
-        member["id"] = i + 123456
-        member["username"] = "test_user_" + str(i)
-        member["name"] = "Test User " + str(i)
-        member["created_by"]["avatar_url"] = "https://any_url_test.test" + str(i)
-        member["created_by"]["web_url"] = "https://any_url_test.test" + str(i)
-        member["created_by"]["id"] = i + 123456
-        member["created_by"]["username"] = "test_user_" + str(i)
-        member["created_by"]["name"] = "Test User " + str(i)
-    if args.persist:
-        persist_contract("project_members.json", data)
-        persist_contract(
-            "project_members_response_headers.json", dict(response.headers)
-        )
-    return response.json()
+        _redact_user(member, i)
+        _redact_user(member["created_by"], i)
+    persist_contract("project_members.json", REMOTE, data)
+    persist_contract(
+        "project_members_response_headers.json", REMOTE, dict(response.headers)
+    )
+    return members
 
 
-def create_merge_request_api():
+def create_merge_request_api(session, persist, conflict_probe):
     url = "https://gitlab.com/api/v4/projects/jordilin%2Fgitlapi/merge_requests"
     source_branch = "feature"
     target_branch = "main"
     title = "New Feature"
-    headers = {"PRIVATE-TOKEN": PRIVATE_TOKEN}
     body = {
         "source_branch": source_branch,
         "target_branch": target_branch,
         "title": title,
     }
-    response = requests.post(url, headers=headers, data=body)
+    response = session.post(url, data=body, timeout=TIMEOUT)
     assert response.status_code == 201
-    data = response.json()
-    if args.persist:
-        persist_contract("merge_request.json", data)
-    # re-create - response with a 409
-    response = requests.post(url, headers=headers, data=body)
+    data = loads(response.content)
+    if persist:
+        persist_contract("merge_request.json", REMOTE, data)
+    if not (conflict_probe or persist):
+        # the conflict response rarely changes, reuse the persisted one.
+        # Persisting always probes, the fixture is refreshed from it.
+        return data, get_contract_json("merge_request_conflict.json", REMOTE).data
+    # re-create - response with a 409. It depends on the merge request
+    # created above, so these two calls cannot be issued concurrently.
+    response = session.post(url, data=body, timeout=TIMEOUT)
     assert response.status_code == 409
-    data_conflict = response.json()
-    if args.persist:
-        persist_contract("merge_request_conflict.json", data_conflict)
+    data_conflict = loads(response.content)
+    if persist:
+        persist_contract("merge_request_conflict.json", REMOTE, data_conflict)
     return data, data_conflict
 
 
-def list_pipelines_api():
+def list_pipelines_api(session, persist):
     # https://docs.gitlab.com/ee/api/pipelines.html
     url = "https://gitlab.com/api/v4/projects/jordilin%2Fgitlapi/pipelines"
-    headers = {"PRIVATE-TOKEN": PRIVATE_TOKEN}
-    response = requests.get(url, headers=headers)
-    data = response.json()[0]
-    if args.persist:
-        persist_contract("list_pipelines.json", data)
+    response = session.get(url, timeout=TIMEOUT)
+    response.raise_for_status()
+    data = loads(response.content)
+    if persist:
+        persist_contract("list_pipelines.json", REMOTE, data)
     return data
 
 
-def get_contract_json(name):
-    with open("contracts/gitlab/{}".format(name)) as fh:
-        data_json = json.load(fh)
-        if type(data_json) == list:
-            # gather one element from list. We just need to verify keys and
-            # types of values.
-            return data_json[0]
-        return data_json
-
-
-def _verify_all_keys_exist(expected, actual):
-    for key in expected:
-        if key not in actual:
-            print("Expected JSON key [{}] not found in upstream".format(key))
-            return False
-        if type(expected[key]) == dict:
-            # API responses checked are not more than one level deep
-            if not _verify_all_keys_exist(expected[key], actual[key]):
-                return False
-    return True
-
-
-def _verify_types_of_values(expected, actual):
-    for key in expected:
-        if type(expected[key]) != type(actual[key]):
-            print(
-                "Type mismatch for key [{}]: expected [{}] but got [{}]".format(
-                    key, type(expected[key]), type(actual[key])
-                )
-            )
-            return False
-        if type(expected[key]) == dict:
-            # API responses checked are not more than one level deep
-            if not _verify_types_of_values(expected[key], actual[key]):
-                return False
-    return True
-
-
-def verify_all(expected, actual):
-    if not _verify_all_keys_exist(expected, actual):
-        return False
-    if not _verify_types_of_values(expected, actual):
-        return False
-    return True
-
-
-class TestAPI:
-    def __init__(self, callback, msg, *expected):
-        self.callback = callback
-        self.msg = msg
-        self.expected = expected
-
-
-def validate_responses(testcases):
-    for testcase in testcases:
-        actual = testcase.callback()
-        print("{}... ".format(testcase.msg), end="")
-        verifications = []
-        if type(actual) == tuple:
-            verifications = zip(testcase.expected, actual)
-        else:
-            verifications = zip(testcase.expected, [actual])
-        for expected, actual in verifications:
-            if not verify_all(expected, actual):
-                return False
-        print("OK")
-    return True
-
-
-if __name__ == "__main__":
+def main(persist, conflict_probe):
+    session = new_session(os.environ["GITLAB_TOKEN"])
+    conflict_probe = conflict_probe or persist
+    mr_msg = "merge request API contract"
+    if not conflict_probe:
+        mr_msg += " (409 probe skipped, use --conflict-probe)"
     testcases = [
         TestAPI(
-            get_project_api_json,
+            lambda: get_project_api_json(session, persist),
             "project API contract",
-            get_contract_json("project.json"),
+            (lambda: get_contract_json("project.json", REMOTE),),
             # TODO: teardown callback close merge request
         ),
         TestAPI(
-            create_merge_request_api,
-            "merge request API contract",
-            get_contract_json("merge_request.json"),
-            get_contract_json("merge_request_conflict.json"),
+            lambda: create_merge_request_api(session, persist, conflict_probe),
+            mr_msg,
+            (
+                lambda: get_contract_json("merge_request.json", REMOTE),
+                lambda: get_contract_json("merge_request_conflict.json", REMOTE),
+            ),
         ),
         TestAPI(
-            list_pipelines_api,
+            lambda: list_pipelines_api(session, persist),
             "list pipelines API contract",
-            get_contract_json("list_pipelines.json"),
+            (lambda: get_contract_json("list_pipelines.json", REMOTE),),
         ),
     ]
     if not validate_responses(testcases):
         exit(1)
     # TODO
     # # get_project_members_api_json()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--persist", action="store_true")
+    parser.add_argument(
+        "--conflict-probe",
+        action="store_true",
+        help="re-create the merge request to verify the 409 conflict response. "
+        "Always done when persisting.",
+    )
+    args = parser.parse_args()
+    main(args.persist, args.conflict_probe)
@@ -53,6 +53,8 @@
             sccache
             just
             python311Packages.requests
+            python311Packages.brotli
+            python311Packages.orjson
             python311Packages.black
             # Github actions locally for fast iteration
             act